@@ -1,4 +1,17 @@
-from setuptools import setup
+from setuptools import setup, Extension
+
+# The compiled PDM kernel is optional: without Cython, or if it fails to
+# build, starspot falls back to the numba kernel.
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(
+        [Extension("starspot._pdm_c", ["starspot/_pdm_c.pyx"],
+                   extra_compile_args=["-O3", "-ffast-math", "-fopenmp"],
+                   extra_link_args=["-fopenmp"],
+                   optional=True)],
+        language_level=3)
+except ImportError:
+    ext_modules = []
 
 setup(name='starspot',
       version='0.2',
@@ -8,6 +21,7 @@ setup(name='starspot',
       author_email='ruthangus@gmail.com',
       license='MIT',
       packages=['starspot'],
-      install_requires=['numpy', 'pandas', 'h5py', 'tqdm', 'emcee', 'jax', 'numpyro', 'tinygp',
+      install_requires=['numpy', 'pandas', 'h5py', 'tqdm', 'emcee', 'numba', 'jax', 'numpyro', 'tinygp',
                          'astropy', 'matplotlib', 'scipy','chainconsumer'],
+      ext_modules=ext_modules,
       zip_safe=False)
@@ -0,0 +1,85 @@
+"""
+Phase dispersion minimization on an NVIDIA GPU, with CuPy.
+"""
+
+import numpy as np
+import cupy as cp
+
+# One CUDA block per trial period. The threads in a block stride over the
+# light curve, binning into histograms in shared memory, and the first
+# thread reduces the bins to phi.
+_source = r"""
+extern "C" __global__
+void pdm_grid(const int nbins, const double* periods, const double* t,
+              const double* x, const long long n, const double sum_sq,
+              const double total_variance, double* phis)
+{
+    extern __shared__ double shared[];
+    double* sums = shared;
+    unsigned long long* counts = (unsigned long long*)&shared[nbins];
+
+    for (int j = threadIdx.x; j < nbins; j += blockDim.x) {
+        sums[j] = 0.;
+        counts[j] = 0;
+    }
+    __syncthreads();
+
+    const double p = periods[blockIdx.x];
+    for (long long i = threadIdx.x; i < n; i += blockDim.x) {
+        double ph = t[i] / p;
+        ph -= floor(ph);
+        int b = (int)(ph * nbins);
+        if (b >= nbins) b = nbins - 1;
+        atomicAdd(&sums[b], x[i]);
+        atomicAdd(&counts[b], 1ULL);
+    }
+    __syncthreads();
+
+    if (threadIdx.x == 0) {
+        double numerator = sum_sq;
+        long long occupied = 0;
+        for (int j = 0; j < nbins; j++) {
+            if (counts[j] > 0) {
+                numerator -= sums[j] * sums[j] / counts[j];
+                occupied++;
+            }
+        }
+        phis[blockIdx.x] = numerator / (n - occupied) / total_variance;
+    }
+}
+"""
+
+_kernel = cp.RawKernel(_source, "pdm_grid")
+_threads_per_block = 256
+
+
+def pdm_grid(nbins, periods, t, x, total_variance):
+    """
+    The phi statistic over a grid of trial periods, evaluated on the GPU.
+
+    Args:
+        nbins (int): The number of bins to use to calculate phase dispersion.
+        periods (array): The trial periods.
+        t (array): The time array.
+        x (array): The flux array.
+        total_variance (float): The variance of x.
+
+    Returns:
+        phis (array): The phi statistic at each trial period.
+
+    """
+    periods = cp.ascontiguousarray(cp.asarray(periods, dtype=cp.float64))
+    t = cp.ascontiguousarray(cp.asarray(t, dtype=cp.float64))
+    x = cp.asarray(x, dtype=cp.float64)
+
+    # Subtract the mean so that the binned variance, a difference of sums
+    # of squares, stays well conditioned.
+    x = cp.ascontiguousarray(x - x.mean())
+    sum_sq = float(cp.dot(x, x))
+
+    phis = cp.empty(periods.shape[0], dtype=cp.float64)
+    _kernel((periods.shape[0],), (_threads_per_block,),
+            (np.int32(nbins), periods, t, x, np.int64(t.shape[0]),
+             np.float64(sum_sq), np.float64(total_variance), phis),
+            shared_mem=nbins * (8 + 8))
+    return cp.asnumpy(phis)
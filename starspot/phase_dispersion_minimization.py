@@ -2,10 +2,24 @@
 Phase dispersion minimisation algorithm, Stellingwerf (1978).
 """
 
+from functools import partial
+
 import numpy as np
+import numba as nb
 import scipy.optimize as sco
 
+import jax
+import jax.numpy as jnp
+
+# The ahead-of-time compiled kernel is only available if starspot was built
+# with Cython. Otherwise the numba kernel is used.
+try:
+    from ._pdm_c import pdm_grid as _pdm_grid_c
+except ImportError:
+    _pdm_grid_c = None
+
 
+@nb.njit(fastmath=True, cache=True)
 def sj2(x, meanx, N):
     """
     The variance of a set of data points in one bin.
@@ -20,9 +34,14 @@ def sj2(x, meanx, N):
 
     """
 
-    return sum((x - meanx)**2)/(N-1)
+    total = 0.
+    for i in range(x.shape[0]):
+        d = x[i] - meanx
+        total += d * d
+    return total/(N-1)
 
 
+@nb.njit(fastmath=True, cache=True)
 def s2(nj, sj2, M):
     """
     Overall variance for the binned data. The s2 statistic (equation 2 of
@@ -38,7 +57,11 @@ def s2(nj, sj2, M):
 
     """
 
-    return sum((nj - 1)*sj2)/(sum(nj) - M)
+    numerator, npoints = 0., 0.
+    for j in range(nj.shape[0]):
+        numerator += (nj[j] - 1)*sj2[j]
+        npoints += nj[j]
+    return numerator/(npoints - M)
 
 
 def calc_phase(p, t):
@@ -56,7 +79,24 @@ def calc_phase(p, t):
     return (t % p)/p
 
 
-def phase_bins(nbins, phase, x):
+def calc_phase_grid(periods, t):
+    """
+    Calculate the phase arrays for several periods at once.
+
+    Args:
+        periods (array): The periods (in days).
+        t (array): The time array (in days).
+
+    Returns
+        phases (array): The phase arrays, shape (len(periods), len(t)). Row
+            k is calc_phase(periods[k], t).
+    """
+
+    periods = np.asarray(periods, dtype=float)[:, None]
+    return (np.asarray(t)[None, :] % periods)/periods
+
+
+def phase_bins(nbins, phase, x, return_bins=False):
     """
     Bin data by phase.
 
@@ -64,35 +104,51 @@ def phase_bins(nbins, phase, x):
         nbins (int): The number of bins.
         phase (float): The phase array.
         x (array): The flux array.
+        return_bins (Optional[bool]): If True, also return the flux and
+            phases in each bin. Default is False.
 
     Returns
         phase_bins (array): The phase bin edges (len = nbins + 1).
         x_means (array): The mean flux in each bin.
         Ns (array): The number of points in each bin.
-        per_bin_variances (array): The variance in each bin.
-        x_binned (list): A list of lists of flux. A list for each bin.
+        per_bin_variances (array): The variance in each bin (zero for bins
+            with fewer than two points).
+        x_binned (list): A list of lists of flux. A list for each bin. None
+            unless return_bins is True.
         phase_binned (list): A list of lists of phases. A list for each bin.
+            None unless return_bins is True.
 
     """
 
     min_phase, max_phase = 0, 1
     phase_bins = np.linspace(min_phase, max_phase, nbins + 1)
-    x_binned, phase_binned = [], []
-    x_means, Ns, per_bin_variances = [np.empty(nbins) for i in range(3)]
-    for j in range(nbins):
-        m = (phase_bins[j] < phase) * (phase < phase_bins[j + 1])
-        Ns[j] = len(x[m])
-        x_means[j] = np.mean(x[m])
-        x_binned.append(x[m])
-        phase_binned.append(phase[m])
-        per_bin_variances[j] = sj2(x[m], x_means[j], Ns[j])
+
+    # Assign every point to a bin in one pass, then accumulate the bins
+    # with bincount. The variances are computed about the bin means (two
+    # passes) for numerical stability.
+    idx = np.minimum((phase*nbins).astype(np.intp), nbins - 1)
+    Ns = np.bincount(idx, minlength=nbins)
+    x_means = np.full(nbins, np.nan)
+    np.divide(np.bincount(idx, weights=x, minlength=nbins), Ns,
+              out=x_means, where=Ns > 0)
+    dx = x - x_means[idx]
+    per_bin_variances = np.zeros(nbins)
+    np.divide(np.bincount(idx, weights=dx*dx, minlength=nbins), Ns - 1,
+              out=per_bin_variances, where=Ns > 1)
+
+    x_binned, phase_binned = None, None
+    if return_bins:
+        order = np.argsort(idx, kind="stable")
+        splits = np.cumsum(Ns)[:-1]
+        x_binned = np.split(x[order], splits)
+        phase_binned = np.split(phase[order], splits)
 
     return x_means, phase_bins, \
         Ns, per_bin_variances, \
         x_binned, phase_binned
 
 
-def phi(nbins, p, t, x):
+def phi(nbins, p, t, x, total_variance=None):
     """
     Calculate the phi statistic in Stellingwerf (1978).
 
@@ -101,6 +157,8 @@ def phi(nbins, p, t, x):
         p (float): The period to calculate the Phi statistic for.
         t (array): The time array.
         x (array): The flux array.
+        total_variance (Optional[float]): The variance of x. Pass this in
+            when calling phi for many periods to avoid recomputing it.
 
     Returns:
         phi (float): The phi statistic. Ratio of the phase-binned variance to
@@ -111,11 +169,232 @@ def phi(nbins, p, t, x):
     phase = calc_phase(p, t)
     x_means, phase_bs, Ns, sj2s, xb, pb = phase_bins(nbins, phase, x)
     total_binned_variance_s2 = s2(Ns, sj2s, nbins)
-    total_variance = sj2(x, np.mean(x), len(x))
+    if total_variance is None:
+        total_variance = sj2(x, np.mean(x), len(x))
 
     return total_binned_variance_s2/total_variance
 
 
+@nb.njit(inline="always", fastmath=True)
+def _phi_scalar(nbins, p, t, x, sum_sq, total_variance):
+    """
+    Compiled equivalent of phi for a single trial period.
+
+    Phase-folds and bins the data in a single pass, accumulating the number
+    of points and the sum in each bin. The per-bin sums of squares add up to
+    the sum of squares of x, sum_sq, whatever the period, so they are not
+    accumulated. Empty bins do not contribute to the binned variance.
+
+    """
+    counts = np.zeros(nbins, dtype=np.int64)
+    sums = np.zeros(nbins)
+    for i in range(t.shape[0]):
+        b = int(((t[i] / p) % 1.) * nbins)
+        if b >= nbins:
+            b = nbins - 1
+        counts[b] += 1
+        sums[b] += x[i]
+
+    numerator, occupied = sum_sq, 0
+    for j in range(nbins):
+        if counts[j] > 0:
+            numerator -= sums[j] * sums[j] / counts[j]
+            occupied += 1
+
+    return numerator / (t.shape[0] - occupied) / total_variance
+
+
+@nb.njit(parallel=True, fastmath=True, cache=True)
+def _pdm_grid(nbins, periods, t, x, total_variance):
+    """
+    The phi statistic over a grid of trial periods, evaluated in parallel.
+
+    Args:
+        nbins (int): The number of bins to use to calculate phase dispersion.
+        periods (array): The trial periods.
+        t (array): The time array (contiguous float64).
+        x (array): The flux array (contiguous float64).
+        total_variance (float): The variance of x.
+
+    Returns:
+        phis (array): The phi statistic at each trial period.
+
+    """
+    # Subtract the mean so that the binned variance, a difference of sums
+    # of squares, stays well conditioned.
+    x = x - np.mean(x)
+    sum_sq = np.sum(x * x)
+
+    phis = np.empty(periods.shape[0])
+    for i in nb.prange(periods.shape[0]):
+        phis[i] = _phi_scalar(nbins, periods[i], t, x, sum_sq,
+                              total_variance)
+    return phis
+
+
+@nb.njit(fastmath=True, cache=True)
+def _bin_stats(nbins, p, t, x):
+    """
+    The number of points, mean and variance of x in each phase bin, for a
+    single trial period. Binned in the same way as _phi_scalar.
+
+    """
+    bins = np.empty(t.shape[0], dtype=np.int64)
+    Ns = np.zeros(nbins, dtype=np.int64)
+    x_means = np.zeros(nbins)
+    for i in range(t.shape[0]):
+        b = int(((t[i] / p) % 1.) * nbins)
+        if b >= nbins:
+            b = nbins - 1
+        bins[i] = b
+        Ns[b] += 1
+        x_means[b] += x[i]
+
+    for j in range(nbins):
+        x_means[j] = x_means[j] / Ns[j] if Ns[j] > 0 else np.nan
+
+    sj2s = np.zeros(nbins)
+    for i in range(t.shape[0]):
+        d = x[i] - x_means[bins[i]]
+        sj2s[bins[i]] += d * d
+    for j in range(nbins):
+        sj2s[j] = sj2s[j] / (Ns[j] - 1) if Ns[j] > 1 else 0.
+
+    return x_means, Ns, sj2s
+
+
+def _phi_jax(nbins, p, t, x, sum_sq, total_variance):
+    """
+    JAX equivalent of _phi_scalar. Bins are accumulated with segment sums
+    so that there is no data-dependent indexing.
+
+    """
+    bin_id = jnp.floor(((t / p) % 1.) * nbins).astype(jnp.int32)
+    bin_id = jnp.minimum(bin_id, nbins - 1)
+    counts = jax.ops.segment_sum(jnp.ones_like(x), bin_id,
+                                 num_segments=nbins)
+    sums = jax.ops.segment_sum(x, bin_id, num_segments=nbins)
+
+    occupied = counts > 0
+    numerator = sum_sq - jnp.sum(jnp.where(
+        occupied, sums**2 / jnp.where(occupied, counts, 1.), 0.))
+    return numerator / (t.shape[0] - jnp.sum(occupied)) / total_variance
+
+
+@partial(jax.jit, static_argnums=(0, 5))
+def _pdm_grid_jax(nbins, periods, t, x, total_variance, batch_size=256):
+    """
+    The phi statistic over a grid of trial periods, compiled with XLA. This
+    runs in whichever precision JAX is configured for (single precision
+    unless jax_enable_x64 is set), so t should be relative to a reference
+    time rather than e.g. in BJD.
+
+    Args:
+        nbins (int): The number of bins to use to calculate phase dispersion.
+        periods (array): The trial periods.
+        t (array): The time array.
+        x (array): The flux array.
+        total_variance (float): The variance of x.
+        batch_size (Optional[int]): The number of trial periods that are
+            vectorized over at once. Larger batches are faster but use
+            batch_size*len(t) memory.
+
+    Returns:
+        phis (array): The phi statistic at each trial period.
+
+    """
+    x = x - jnp.mean(x)
+    sum_sq = jnp.sum(x * x)
+    return jax.lax.map(
+        lambda p: _phi_jax(nbins, p, t, x, sum_sq, total_variance), periods,
+        batch_size=batch_size)
+
+
+def phi_grid(nbins, periods, t, x, total_variance=None, backend="cpu",
+             return_best=False):
+    """
+    Calculate the phi statistic in Stellingwerf (1978) over a grid of
+    periods.
+
+    Args:
+        nbins (int): The number of bins to use to calculate phase dispersion.
+        periods (array): The periods to calculate the Phi statistic for.
+        t (array): The time array.
+        x (array): The flux array.
+        total_variance (Optional[float]): The variance of x. Pass this in
+            when scanning several grids of periods to avoid recomputing it.
+        backend (Optional[str]): Either "cpu", to evaluate the period grid
+            with a parallel compiled kernel (the Cython extension if
+            starspot was built with it, numba otherwise), "jax", to
+            evaluate it with XLA (on a GPU if one is available), or "cupy",
+            to evaluate it with a CUDA kernel (requires CuPy). Default is
+            "cpu".
+        return_best (Optional[bool]): If True, also return the binned light
+            curve at the period with the lowest phi. Default is False.
+
+    Returns:
+        phis (array): The phi statistic at each period.
+        best_bins (tuple): Only if return_best is True. The mean flux, the
+            number of points and the variance in each bin at the period with
+            the lowest phi, as returned by phase_bins.
+
+    """
+
+    if total_variance is None:
+        total_variance = float(np.var(x, ddof=1))
+
+    # Phases are measured from the first time, offset in double precision
+    # on the host, so that every backend bins the light curve the same way
+    # and times keep their resolution in single precision on a device. JAX
+    # arrays are assumed to be offset already.
+    if not isinstance(t, jax.Array):
+        t = np.asarray(t, dtype=np.float64)
+        t = t - t[0]
+
+    if backend == "cpu":
+        kernel = _pdm_grid if _pdm_grid_c is None else _pdm_grid_c
+        phis = kernel(nbins,
+                      np.ascontiguousarray(periods, dtype=np.float64),
+                      np.ascontiguousarray(t, dtype=np.float64),
+                      np.ascontiguousarray(x, dtype=np.float64),
+                      total_variance)
+    elif backend == "jax":
+        phis = np.asarray(_pdm_grid_jax(nbins, jnp.asarray(periods),
+                                        jnp.asarray(t), jnp.asarray(x),
+                                        total_variance))
+    elif backend == "cupy":
+        from ._pdm_gpu import pdm_grid as _pdm_grid_gpu
+        phis = _pdm_grid_gpu(nbins, periods, t, x, total_variance)
+    else:
+        raise ValueError("backend must be 'cpu', 'jax' or 'cupy'.")
+
+    if not return_best:
+        return phis
+    best_period = float(np.asarray(periods)[np.argmin(phis)])
+    return phis, _bin_stats(nbins, best_period,
+                            np.ascontiguousarray(t, dtype=np.float64),
+                            np.ascontiguousarray(x, dtype=np.float64))
+
+
+def _parabola_vertex(periods, y):
+    """
+    The period at the vertex of the parabola through three points, where
+    y[1] is the smallest. The parabola is fit in frequency, in which the
+    dispersion trough is symmetric. Falls back to periods[1] if the points
+    are collinear, or if the vertex is more than half a grid step (in
+    frequency) from the middle point, where the trough is too coarsely
+    sampled or too asymmetric for a parabola to be trusted.
+    """
+    f = 1./np.asarray(periods)
+    a, b, _ = np.polyfit(f, y, 2)
+    if not a > 0:
+        return periods[1]
+    f_vertex = -b/(2*a)
+    if abs(f_vertex - f[1]) > .5*min(abs(f[0] - f[1]), abs(f[2] - f[1])):
+        return periods[1]
+    return 1./f_vertex
+
+
 def gaussian(pars, x):
     """
     A Gaussian, with a baseline of b.
@@ -148,8 +427,7 @@ def estimate_uncertainty(period_grid, phi, best_period):
 
     # Peak finder
     def peaks(y):
-        return np.array([i for i in range(1, len(y)-1) if y[i-1] <
-                         y[i] and y[i+1] < y[i]])
+        return np.flatnonzero((y[1:-1] > y[:-2]) & (y[1:-1] > y[2:])) + 1
 
     # limit to a section around the trough.
     # Find peaks adjacent to the dip.
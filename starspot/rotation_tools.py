@@ -12,6 +12,7 @@ import scipy.interpolate as spi
 # import kplr
 from astropy.timeseries import BoxLeastSquares
 import scipy.signal as sps
+import scipy.fft as spf
 
 plotpar = {'axes.labelsize': 25,
            'xtick.labelsize': 20,
@@ -155,11 +156,15 @@ def dan_acf(x, axis=0, fast=False):
         n = x.shape[axis]
 
     # Compute the FFT and then (from that) the auto-correlation function.
-    f = np.fft.fft(x-np.mean(x, axis=axis), n=2*n, axis=axis)
+    # The input is real, so only the non-negative frequencies are needed,
+    # and it is zero-padded to at least 2n (to avoid wrap-around) and to a
+    # length the FFT handles efficiently.
+    nfft = spf.next_fast_len(2*n, real=True)
+    f = spf.rfft(x-np.mean(x, axis=axis, keepdims=True), n=nfft, axis=axis)
     m[axis] = slice(0, n)
-    acf = np.fft.ifft(f * np.conjugate(f), axis=axis)[tuple(m)].real
-    m[axis] = 0
-    return acf / acf[m]
+    acf = spf.irfft(f * np.conjugate(f), n=nfft, axis=axis)[tuple(m)]
+    m[axis] = slice(0, 1)
+    return acf / acf[tuple(m)]
 
 
 def interp(x_gaps, y_gaps, interval, interp_style="zero"):
@@ -196,7 +201,8 @@ def simple_acf(x_gaps, y_gaps, interval, smooth=9, window_length=99,
         interval (Optional[float]): The time interval between successive
             observations. The default is Kepler cadence.
         smooth (Optional[float]): The smoothing timescale.
-        window_length (Optional[float]): The filter window length.
+        window_length (Optional[float]): The filter window length. If None,
+            the ACF is not smoothed.
         polyorder (Optional[float]): The polynomial order of the filter.
         interp_style (string): The type of interpolation, e.g. "zero" or
             "linear". The default is "zero".
@@ -225,17 +231,18 @@ def simple_acf(x_gaps, y_gaps, interval, smooth=9, window_length=99,
     # ditch the first point
     acf, lags = acf[1:], lags[1:]
 
-    N = len(acf)
-    double_acf, double_lags = [np.zeros((2*N)) for i in range(2)]
-    double_acf[:N], double_lags[:N] = acf[::-1], -lags[::-1]
-    double_acf[N:], double_lags[N:] = acf, lags
-    acf, lags = double_acf, double_lags
+    if window_length is None:
+        return lags, acf, x, y
 
-    # Smooth the data with a Savitsky-Golay filter.
-    acf_smooth = sps.savgol_filter(acf, window_length, polyorder)
+    # Smooth the data with a Savitsky-Golay filter, reflecting the ACF about
+    # zero lag. Only the first half-window of the reflection reaches the
+    # positive lags, so only that much is prepended.
+    h = min(window_length//2, len(acf))
+    acf_smooth = sps.savgol_filter(np.concatenate((acf[:h][::-1], acf)),
+                                   window_length, polyorder)
 
     # just use the second bit (no reflection)
-    acf_smooth, lags = acf_smooth[N:], lags[N:]
+    acf_smooth = acf_smooth[h:]
 
     return lags, acf_smooth, x, y
 
@@ -373,8 +380,7 @@ def get_peak_statistics(x, y, sort_by="height"):
     """
 
     # Array of peak indices
-    peaks = np.array([i for i in range(1, len(y)-1) if y[i-1] <
-                      y[i] and y[i+1] < y[i]])
+    peaks = np.flatnonzero((y[1:-1] > y[:-2]) & (y[1:-1] > y[2:])) + 1
 
     # extract peak values
     x_peaks = x[peaks]
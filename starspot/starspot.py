@@ -2,6 +2,10 @@
 A script for measuring the rotation periods of a set of stars.
 """
 
+import os
+from contextlib import contextmanager
+from functools import lru_cache
+
 import numpy as np
 from .rotation_tools import simple_acf, get_peak_statistics
 
@@ -9,9 +13,8 @@ import matplotlib.pyplot as plt
 from matplotlib import gridspec
 import pandas as pd
 import astropy.timeseries as apt
-from .phase_dispersion_minimization import phi, calc_phase, phase_bins, \
-    estimate_uncertainty, gaussian
-from tqdm import tqdm, trange
+from .phase_dispersion_minimization import calc_phase, calc_phase_grid, \
+    phase_bins, estimate_uncertainty, gaussian, phi_grid, _parabola_vertex
 
 import jax
 import jax.numpy as jnp
@@ -22,10 +25,17 @@ from numpyro.diagnostics import gelman_rubin
 from numpyro.infer import MCMC, NUTS
 
 from tinygp import kernels, GaussianProcess
+from tinygp.solvers.quasisep.block import Block
 
 from chainconsumer import ChainConsumer
 
-jax.config.update("jax_enable_x64", True)
+# Expose the CPU cores as separate XLA devices so that MCMC chains can run in
+# parallel. To choose the number of devices yourself, set
+# XLA_FLAGS=--xla_force_host_platform_device_count=N before importing
+# starspot.
+if "xla_force_host_platform_device_count" not in os.environ.get("XLA_FLAGS",
+                                                                 ""):
+    numpyro.set_host_device_count(min(os.cpu_count() or 1, 4))
 
 
 plotpar = {'axes.labelsize': 25,
@@ -46,22 +56,107 @@ class RotationModel(object):
     """
 
     def __init__(self, time, flux, flux_err):
-        self.time = time
+        # The light curve is checked and converted once, here, rather than
+        # by every method that uses it.
+        self.time = np.ascontiguousarray(time, dtype=np.float64)
+        self.reset_series(flux, flux_err)
+
+    def reset_series(self, flux, flux_err):
+        """
+        Replace the flux and flux uncertainties, keeping the same time array.
+
+        This is cheaper than building a new RotationModel, e.g. when
+        measuring periods for many light curves with the same cadence. Any
+        cached periodogram and device arrays are discarded.
+
+        Args:
+            flux (array): The flux array.
+            flux_err (array): The array of flux uncertainties.
+        """
+        flux = np.ascontiguousarray(flux, dtype=np.float64)
+        flux_err = np.ascontiguousarray(flux_err, dtype=np.float64)
+        assert flux.shape == self.time.shape, "flux must be the same " \
+            "length as time."
+        assert np.isfinite(flux).all(), "Remove NaNs from your flux " \
+            "array before trying to measure a rotation period."
         self.flux = flux
         self.flux_err = flux_err
-        self.Rvar = np.percentile(flux, 95) - np.percentile(flux, 5)
+        self.Rvar = _percentile_range(self.flux, 5, 95)
+        self._ls = None
+        self._freq_cache_key = None
+        self._logfreq = None
+        self._jax_cache = {}
+
+    def _jax_arrays(self, dtype):
+        """
+        The time, flux and flux_err arrays on the JAX device, in dtype.
+
+        Times are relative to the first one. They are offset in double
+        precision on the host, so that they keep their resolution in single
+        precision. The copies are made once per dtype and reused by later
+        calls.
+        """
+        dtype = jnp.dtype(dtype)
+        if dtype not in self._jax_cache:
+            self._jax_cache[dtype] = tuple(
+                jax.device_put(x.astype(dtype)) for x in
+                (self.time - self.time[0], self.flux, self.flux_err))
+        return self._jax_cache[dtype]
+
+    def _gp_arrays(self, dtype):
+        """
+        The GP inputs (t, y, yerr) on the JAX device, in dtype.
+
+        Times are relative to the first one and the flux is median
+        normalized, both in double precision on the host, and the device
+        copies are made once per dtype and reused by later calls.
+        """
+        dtype = jnp.dtype(dtype)
+        key = ("gp", dtype)
+        if key not in self._jax_cache:
+            # Median of data must be zero
+            med = np.median(self.flux)
+            self._jax_cache[key] = tuple(
+                jax.device_put(x.astype(dtype)) for x in
+                (self.time - self.time[0], (self.flux - med)/med,
+                 self.flux_err/med))
+        return self._jax_cache[key]
+
+    @property
+    def time_jax(self):
+        """
+        The time array on the JAX device, in JAX's default precision, relative
+        to the first time.
+        """
+        return self._jax_arrays(jnp.result_type(float))[0]
+
+    @property
+    def flux_jax(self):
+        """The flux array on the JAX device, in JAX's default precision."""
+        return self._jax_arrays(jnp.result_type(float))[1]
+
+    @property
+    def flux_err_jax(self):
+        """The flux_err array on the JAX device, in JAX's default precision."""
+        return self._jax_arrays(jnp.result_type(float))[2]
 
     # def calc_Rvar(self):
     #     Rvar = np.percentile(self.flux, 95) - np.percentile(self.flux, 5)
     #     self.Rvar = Rvar
     #     return Rvar
 
-    def lc_plot(self):
+    def lc_plot(self, max_display=20000):
         """
         Plot the light curve.
+
+        Args:
+            max_display (Optional[int]): The maximum number of points to
+                plot. Longer light curves are evenly thinned. Default is
+                20000.
         """
         plt.figure(figsize=(20, 5))
-        plt.plot(self.time, self.flux, "k.", ms=.5);
+        plt.plot(*_downsample(self.time, self.flux, max_display), "k.",
+                 ms=.5);
         plt.xlabel("Time [days]")
         plt.ylabel("Relative Flux");
         plt.subplots_adjust(bottom=.2)
@@ -82,6 +177,8 @@ class RotationModel(object):
                 days but for K2 it should probably be more like 20-25 days
                 and 10-15 days for TESS. Default is 50.
             samples_per_peak (Optional[int]): The number of samples per peak.
+                The frequency grid is evenly spaced, with this many samples
+                per 1/baseline in frequency. Default is 50.
 
         Returns:
             ls_period (float): The Lomb-Scargle rotation period.
@@ -90,27 +187,45 @@ class RotationModel(object):
         if input_freq is not None and input_power is not None:
             self.freq = input_freq
             self.power = input_power
-        else:
-            self.freq = np.linspace(1./max_period, 1./min_period, 100000)
+            self._logfreq = None
+            self._freq_cache_key = None
+            freq_key = None
+        elif input_ls_period is None:
+            # The grid is left alone when the period is given, so that it
+            # always matches the stored power.
+            freq_key = (min_period, max_period, samples_per_peak)
+            if freq_key != self._freq_cache_key:
+                baseline = np.max(self.time) - np.min(self.time)
+                nfreq = int(samples_per_peak * baseline
+                            * (1./min_period - 1./max_period))
+                self.freq = np.linspace(1./max_period, 1./min_period, nfreq)
+                self._logfreq = None
 
         if input_ls_period is not None:
             self.ls_period = input_ls_period
             return input_ls_period
 
-        assert len(self.flux) == sum(np.isfinite(self.flux)), "Remove NaNs" \
-            " from your flux array before trying to compute a periodogram."
-
-        self.power = apt.LombScargle(
-            self.time, self.flux).power(self.freq)
+        # The LombScargle object is only built once per light curve, and the
+        # periodogram is only recomputed if the frequency grid has changed.
+        # The fast (O[N log N]) method requires an evenly spaced frequency
+        # grid, which is only guaranteed if we built it ourselves.
+        if self._ls is None:
+            self._ls = apt.LombScargle(self.time, self.flux, self.flux_err)
+        if freq_key is None:
+            self.power = self._ls.power(self.freq)
+        elif freq_key != self._freq_cache_key:
+            self.power = self._ls.power(self.freq, method="fast",
+                                        assume_regular_frequency=True)
+            self._freq_cache_key = freq_key
 
         ps = 1./self.freq
-        peaks = np.array([i for i in range(1, len(ps)-1) if self.power[i-1] <
-                          self.power[i] and self.power[i+1] < self.power[i]])
+        p = self.power
+        peaks = np.flatnonzero((p[1:-1] > p[:-2]) & (p[1:-1] > p[2:])) + 1
 
         if len(peaks) == 0:
             self.ls_period = 0
         else:
-            self.ls_period = ps[self.power == max(self.power[peaks])][0]
+            self.ls_period = ps[peaks[np.argmax(p[peaks])]]
         return self.ls_period
 
 
@@ -120,11 +235,14 @@ class RotationModel(object):
 
         """
 
+        if self._logfreq is None:
+            self._logfreq = -np.log10(self.freq)
+
         fig = plt.figure(figsize=(16, 9))
-        plt.plot(-np.log10(self.freq), self.power, "k", zorder=0)
+        plt.plot(self._logfreq, self.power, "k", zorder=0)
         plt.axvline(np.log10(self.ls_period), color="C1", lw=4, alpha=0.5,
                     zorder=1)
-        plt.xlim((-np.log10(self.freq)).min(), (-np.log10(self.freq)).max())
+        plt.xlim(self._logfreq.min(), self._logfreq.max())
         plt.yticks([])
         plt.xlabel("log10(Period [days])")
         plt.ylabel("Power");
@@ -189,7 +307,8 @@ class RotationModel(object):
         if return_fig:
             return fig
 
-    def pdm_rotation(self, period_grid, pdm_nbins=10):
+    def pdm_rotation(self, period_grid, pdm_nbins=10, backend="cpu",
+                     refine=False):
         """
         Calculate the optimum period from phase dispersion minimization.
 
@@ -197,6 +316,15 @@ class RotationModel(object):
             period_grid (array): The period grid.
             pdm_nbins (array): The number of bins to use when calculating phase
                 dispersion.
+            backend (Optional[str]): "cpu", to evaluate the period grid
+                with a parallel compiled kernel, "jax", to evaluate it with
+                XLA (on a GPU if one is available), or "cupy", to evaluate it
+                with a CUDA kernel (requires CuPy). Default is "cpu".
+            refine (Optional[bool]): If True, refine the period beyond the
+                grid spacing with a parabola through the lowest phi and its
+                two neighbours. The refined period stays within half a grid
+                step (in frequency) of the grid minimum. Only use this on
+                grids that resolve the dispersion trough. Default is False.
 
         Returns:
             phis (array): The array of phi statistics
@@ -205,11 +333,15 @@ class RotationModel(object):
         self.pdm_nbins = pdm_nbins
         self.period_grid = period_grid
 
-        nperiods = len(period_grid)
-        phis = np.zeros(nperiods)
-        # for i, p in enumerate(period_grid):
-        for i in trange(len(period_grid)):
-            phis[i] = phi(pdm_nbins, period_grid[i], self.time, self.flux)
+        # The total variance does not depend on the trial period, so it is
+        # computed once, in double precision, for either backend.
+        total_variance = np.var(self.flux, ddof=1)
+        if backend == "jax":
+            phis = phi_grid(pdm_nbins, period_grid, self.time_jax,
+                            self.flux_jax, total_variance, backend="jax")
+        else:
+            phis = phi_grid(pdm_nbins, period_grid, self.time, self.flux,
+                            total_variance, backend=backend)
 
         self.phis = phis
 
@@ -218,6 +350,9 @@ class RotationModel(object):
         self.pdm_period = period_grid[ind]
         if hasattr(self.pdm_period, 'len'):
             self.pdm_period = self.pdm_period[0]
+        if refine and 0 < ind < len(phis) - 1:
+            self.pdm_period = _parabola_vertex(period_grid[ind-1:ind+2],
+                                               phis[ind-1:ind+2])
 
         # Estimate the uncertainty
         err, mu, a, b = estimate_uncertainty(period_grid, phis,
@@ -234,16 +369,16 @@ class RotationModel(object):
 
         return self.pdm_period, err
 
-    def pdm_plot(self,return_fig=False):
+    def pdm_plot(self,return_fig=False, show_bins=False):
         """
         Make a plot of the phase dispersion function.
 
-        """
-        # Calculate phase, etc.
-        x_means, phase_bs, Ns, sj2s, xb, pb = \
-            phase_bins(self.pdm_nbins, self.phase, self.flux)
-        mid_phase_bins = np.diff(phase_bs)*.5 + phase_bs[:-1]
+        Args:
+            show_bins (Optional[bool]): If true, overplot the mean and
+                standard error of the flux in each phase bin. Default is
+                False.
 
+        """
         fig = plt.figure(figsize=(16, 9), dpi=200)
         ax1 = fig.add_subplot(311)
         ax1.plot(self.time, self.flux, "k.", ms=1, alpha=.5)
@@ -252,7 +387,12 @@ class RotationModel(object):
 
         ax2 = fig.add_subplot(312)
         ax2.plot(self.phase, self.flux, "k.", alpha=.1)
-        # ax2.errorbar(mid_phase_bins, x_means, yerr=sj2s, fmt=".")
+        if show_bins:
+            x_means, phase_bs, Ns, sj2s, xb, pb = \
+                phase_bins(self.pdm_nbins, self.phase, self.flux)
+            mid_phase_bins = .5*(phase_bs[1:] + phase_bs[:-1])
+            ax2.errorbar(mid_phase_bins, x_means, yerr=np.sqrt(sj2s/Ns),
+                         fmt=".")
         ax2.set_xlabel("Phase")
         ax2.set_ylabel("Flux")
 
@@ -270,7 +410,8 @@ class RotationModel(object):
         if return_fig:
             return fig
 
-    def big_plot(self, methods, xlim=None, method_xlim=(0, 50),return_fig=False):
+    def big_plot(self, methods, xlim=None, method_xlim=(0, 50),return_fig=False,
+                 max_display=20000):
         """
         Make a plot of LS periodogram, ACF and PDM, combined. These things
         must be precomputed.
@@ -281,6 +422,9 @@ class RotationModel(object):
             xlim (Optional[tuple]): The xlim for the light curve panel.
             method_xlim (Optional[tuple]): The xlim for the methods panel.
                 Default is 0-50 days.
+            max_display (Optional[int]): The maximum number of points to
+                plot in the light curve panel. Longer light curves are evenly
+                thinned. Default is 20000.
 
         Returns:
             The figure object.
@@ -293,7 +437,7 @@ class RotationModel(object):
         inds, i_s, names = np.arange(3), [], np.array(["pdm", "ls", "acf"])
         for i in range(nmethods):
             mask = methods[i] == names
-            i_s.append(int(inds[mask]))
+            i_s.append(int(inds[mask][0]))
         i_s = np.array(i_s)
 
         outer = gridspec.GridSpec(3, nmethods,
@@ -308,8 +452,8 @@ class RotationModel(object):
         # ax1.plot(self.time, self.flux, "k", lw=.5, rasterized=True)
         # ax1.errorbar(self.time, self.flux, yerr=self.flux_err,
                      # fmt="k.", alpha=.1, rasterized=True)
-        ax1.plot(self.time, self.flux, "k.", alpha=.3, mec="none",
-                 rasterized=True)
+        ax1.plot(*_downsample(self.time, self.flux, max_display), "k.",
+                 alpha=.3, mec="none", rasterized=True)
         ax1.set_xlabel("$\mathrm{Time~[days]}$")
         ax1.set_ylabel("$\mathrm{Normalized~Flux}$")
         if xlim is not None:
@@ -326,16 +470,23 @@ class RotationModel(object):
         if np.any(i_s == 1):
             ls_tit = " LS = {0:.2f} days.".format(self.ls_period)
             ls_x, ls_y, ls_p = 1./self.freq, self.power, self.ls_period
-            ls_phase = calc_phase(self.ls_period, self.time)
         else:
             ls_x, ls_y, ls_p, ls_phase = None, None, None, None
         if np.any(i_s == 2):
             acf_tit = " ACF = {0:.2f} days.".format(self.acf_period)
             acf_x, acf_y, acf_p = self.lags, self.acf, self.acf_period
-            acf_phase = calc_phase(self.acf_period, self.time)
         else:
             acf_x, acf_y, acf_p, acf_phase = None, None, None, None
 
+        # Fold the light curve on the LS and ACF periods in a single pass.
+        # The PDM phase has already been computed by pdm_rotation.
+        fold = [p is not None for p in (ls_p, acf_p)]
+        if any(fold):
+            phases = iter(calc_phase_grid(
+                [p for p in (ls_p, acf_p) if p is not None], self.time))
+            ls_phase = next(phases) if fold[0] else None
+            acf_phase = next(phases) if fold[1] else None
+
         plt.title("{0}{1}{2}".format(pdm_tit, ls_tit, acf_tit), fontsize=20)
 
         # The phase-fold panel
@@ -348,10 +499,16 @@ class RotationModel(object):
         xlabels = ["$\mathrm{PDM~Phase}$", "$\mathrm{LS~Phase}$",
                    "$\mathrm{ACF~Phase}$"]
 
-        colors = ["k", "C0", "C1"]
+        cmaps = ["Greys", "Blues", "Oranges"]
         def phase_subplot(x, y, i, xlabel):
             ax = fig.add_subplot(gs1[0, i])
-            ax.plot(x, y, ".", color=colors[i], alpha=.1, rasterized=True)
+            # Draw the phase-folded light curve as a 2D histogram rather than
+            # one marker per point.
+            H, xe, ye = np.histogram2d(x, y, bins=(200, 200),
+                                       range=((0, 1), (y.min(), y.max())))
+            ax.imshow(np.ma.masked_equal(H.T, 0), origin="lower",
+                      extent=[0, 1, ye[0], ye[-1]],
+                      aspect="auto", cmap=cmaps[i], interpolation="nearest")
             ax.set_xlabel(xlabel)
             ax.set_xlim(0, 1)
             return ax
@@ -405,7 +562,7 @@ class RotationModel(object):
         # Plot a Gaussian on top of PDM plot
         axloc_ind = np.arange(len(maxs))[np.array(i_s) == 0]
         if np.any(i_s == 0):
-            ax3 = maxs[int(axloc_ind)]
+            ax3 = maxs[int(axloc_ind[0])]
             ax3.plot(self.period_grid, gaussian([self.a, self.b, self.mu,
                                              self.sigma], self.period_grid),
                      rasterized=True)
@@ -419,7 +576,8 @@ class RotationModel(object):
         
 
     def gp_rotation(self, init_period=None, tune=2000, draws=2000,
-                    prediction=True, cores=None):
+                    prediction=True, cores=None, num_chains=4,
+                    precision="float64", n_pred_points=2000, pred_thin=10):
         """
         Calculate a rotation period using a Gaussian process method.
 
@@ -430,100 +588,117 @@ class RotationModel(object):
                 2000.
             draws (Optional[int]): The number of samples. Default is 2000.
             prediction (Optional[Bool]): If true, a prediction will be
-                calculated for each sample. This is useful for plotting the
-                prediction but will slow down the whole calculation.
+                calculated for every pred_thin-th sample after sampling.
+                This is useful for plotting the prediction but will slow
+                down the whole calculation.
+            num_chains (Optional[int]): The number of MCMC chains. Chains
+                are run in parallel, one per XLA device, if there are enough
+                devices (e.g. CPU cores or GPUs), and are otherwise
+                vectorized on a single device. Default is 4.
+            precision (Optional[str]): "float64" or "float32". Sampling in
+                single precision roughly halves the cost of the GP likelihood
+                and its memory footprint, at the expense of accuracy on very
+                long baselines. Default is "float64".
+            n_pred_points (Optional[int]): The number of times at which the
+                prediction is evaluated. Default is 2000.
+            pred_thin (Optional[int]): Compute the prediction for one in
+                every pred_thin posterior samples. Default is 10.
         """
         self.prediction = prediction
 
-        t = jnp.array(self.time, dtype=float)
-        dt = jnp.median(jnp.diff(t))
-        t_fine = jnp.linspace(t.min()-dt*5, t.max()+dt*5, np.max([1000, len(t)*10]))
-        # Median of data must be zero
-        y = (jnp.array(self.flux, dtype=float) - jnp.median(self.flux))/jnp.median(self.flux)
-        # y = y = (y / jnp.median(self.flux) - 1) * 1e3
-        yerr = jnp.array(self.flux_err, dtype=float)/ jnp.median(self.flux)
-
-        if init_period is None:
-            # Calculate ls period
-            init_period = self.ls_rotation()
-
-        def numpyro_model(t, yerr, y=None):
-            # The mean flux of the time series
-            mean = numpyro.sample("mean", dist.Normal(0.0, 10.0))
-
-            # A jitter term describing excess white noise
-            log_jitter = numpyro.sample("log_jitter", dist.Normal(jnp.log(jnp.min(yerr)), 2.5))
-
-            log_Sw4 = numpyro.sample("log_Sw4", dist.Normal(0.5*jnp.log(jnp.var(y)), 2.5))
-            log_w0 = numpyro.sample("log_w0", dist.Normal(jnp.log(2 * jnp.pi / 10.), 5.0))
-
-            # The parameters of the RotationTerm kernel
-            log_sigma = numpyro.sample("log_sigma", dist.Normal(0.5*jnp.log(jnp.var(y)), 2.5))
-            log_period = numpyro.sample("log_period", dist.Normal(jnp.log(init_period), 2.0))
-            log_Q0 = numpyro.sample("log_Q0", dist.Normal(2.0, 4.0))
-            log_deltaQ = numpyro.sample("log_deltaQ", dist.Normal(2.0, 10.0))
-            log_f = numpyro.sample("log_f", dist.Uniform(-4, 0))
-
-            # Track the period as a deterministic
-            period = numpyro.deterministic("period",jnp.exp(log_period))
-            params = {'log_sigma': log_sigma, 'log_period': log_period, 'log_Q0': log_Q0,
-                        'log_deltaQ': log_deltaQ, 'log_f': log_f, 
-                        'mean': mean, 'log_jitter': log_jitter,
-                        'log_Sw4': log_Sw4, 'log_w0': log_w0}
-            # sigma, period, Q0, dQ, f = jnp.exp(params['log_sigma'], params['log_period'], 
-            #                            params['log_Q0'], params['log_deltaQ'], params['log_f'])
-
-            gp = build_gp(params,t,yerr)
-            numpyro.sample("gp", gp.numpyro_dist(), obs=y)
-
-            if self.prediction:
-                if y is not None:
-                    numpyro.deterministic("pred", gp.condition(y, t_fine).gp.loc)
-        
-        self.model = numpyro_model
-
-        print("Sampling")
-        nuts_kernel = NUTS(numpyro_model, dense_mass=True, target_accept_prob=0.9)
-        mcmc = MCMC(
-            nuts_kernel,
-            num_warmup=tune,
-            num_samples=draws,
-            num_chains=2,
-            progress_bar=True,
-        )
-        rng_key = jax.random.PRNGKey(34923)
-
-        mcmc.run(rng_key, t, yerr, y=y)
-        samples = mcmc.get_samples()
-
-        # Save samples
-        self.samples = samples
-
-        test_chain = np.array([self.samples[key] for key in ['log_Q0', 'period', 'log_sigma', 'log_deltaQ', 'log_jitter', 'mean', 'log_f']]).T
-        self.gr = gelman_rubin(test_chain)
-        if self.gr > 1.1:
-            print("WARNING: Gelman-Rubin statistic is %.3f. This may indicate" \
-                " sampling issues." % gr)
+        if precision not in ("float32", "float64"):
+            raise ValueError("precision must be 'float32' or 'float64'.")
+        # JAX's 64 bit mode is process wide, so it is only changed while
+        # sampling and restored afterwards.
+        with _x64(precision == "float64"):
+            dtype = jnp.dtype(precision)
+
+            t, y, yerr = self._gp_arrays(dtype)
+            # The prediction times are kept in double precision on the host,
+            # and offset like t on the device.
+            dt = np.median(np.diff(self.time))
+            t_fine = np.linspace(self.time.min()-dt*5, self.time.max()+dt*5,
+                                 n_pred_points)
+
+            if init_period is None:
+                # Calculate ls period
+                init_period = self.ls_rotation()
+
+            # Prior locations are computed outside the model and passed in as
+            # data, so that they are traced rather than baked into the graph.
+            log_min_yerr = jnp.log(jnp.min(yerr))
+            log_std_y = 0.5*jnp.log(jnp.var(y))
+            log_init_period = jnp.log(jnp.asarray(init_period, dtype=dtype))
+
+            self.model = _rotation_model
+
+            print("Sampling")
+            # Chains are mapped over devices if there are enough of them, or
+            # run in lockstep on one.
+            if jax.local_device_count() >= num_chains:
+                chain_method = "parallel"
+            else:
+                chain_method = "vectorized"
+            mcmc = _get_mcmc(tune, draws, num_chains, chain_method, len(t),
+                             precision)
+            # numpyro expects one key per chain, or a single key for one chain.
+            rng_keys = jax.random.PRNGKey(34923)
+            if num_chains > 1:
+                rng_keys = jax.random.split(rng_keys, num_chains)
+
+            mcmc.run(rng_keys, t, yerr, log_min_yerr, log_std_y,
+                     log_init_period, y=y)
+            chain_samples = mcmc.get_samples(group_by_chain=True)
+            samples = {k: v.reshape((-1,) + v.shape[2:])
+                       for k, v in chain_samples.items()}
+
+            # Save samples
+            self.samples = samples
+
+            # Stack the parameters on device, (chains, draws, params), and copy
+            # them to the host once.
+            keys = ['log_Q0', 'period', 'log_sigma', 'log_deltaQ', 'log_jitter',
+                    'mean', 'log_f']
+            test_chain = np.asarray(
+                jnp.stack([chain_samples[key] for key in keys], axis=-1))
+            if num_chains > 1:
+                self.gr = float(np.max(gelman_rubin(test_chain)))
+            else:
+                self.gr = np.nan
+            if self.gr > 1.1:
+                print("WARNING: Gelman-Rubin statistic is %.3f. This may indicate" \
+                    " sampling issues." % self.gr)
             
-        self.pred = samples["pred"]
+            # The prediction is only needed for plotting, so it is computed
+            # after sampling, for a thinned set of samples, one at a time and
+            # stored in single precision.
+            self.pred_thin = pred_thin
+            if prediction:
+                thinned = {k: v[::pred_thin] for k, v in samples.items()}
+                self.pred = np.asarray(jax.lax.map(
+                    lambda params: build_gp(params, t, yerr).condition(
+                        y, jnp.asarray(t_fine - self.time[0], dtype=dtype)
+                    ).gp.loc, thinned), dtype=np.float32)
+            else:
+                self.pred = None
 
-        self.period_samples = samples["period"]
-        self.gp_period = np.median(self.period_samples)
-        lower = np.percentile(self.period_samples, 16)
-        upper = np.percentile(self.period_samples, 84)
-        self.errm = self.gp_period - lower
-        self.errp = upper - self.gp_period
+            self.period_samples = samples["period"]
+            self.gp_period = np.median(self.period_samples)
+            lower = np.percentile(self.period_samples, 16)
+            upper = np.percentile(self.period_samples, 84)
+            self.errm = self.gp_period - lower
+            self.errp = upper - self.gp_period
 
-        print('GP Period: %.3f + %.3f - %.3f' % (self.gp_period, self.errp, self.errm))
+            print('GP Period: %.3f + %.3f - %.3f' % (self.gp_period, self.errp, self.errm))
 
-        self.logQ = np.median(samples["log_Q0"])
-        upperQ = np.percentile(samples["log_Q0"], 84)
-        lowerQ = np.percentile(samples["log_Q0"], 16)
-        self.Qerrp = upperQ - self.logQ
-        self.Qerrm = self.logQ - lowerQ
-        self.t_fine = t_fine
+            self.logQ = np.median(samples["log_Q0"])
+            upperQ = np.percentile(samples["log_Q0"], 84)
+            lowerQ = np.percentile(samples["log_Q0"], 16)
+            self.Qerrp = upperQ - self.logQ
+            self.Qerrm = self.logQ - lowerQ
+            self.t_fine = t_fine
 
-        return self.gp_period, self.errp, self.errm
+            return self.gp_period, self.errp, self.errm
 
     def plot_prediction(self,return_fig=False):
         """
@@ -536,12 +711,15 @@ class RotationModel(object):
             return
 
         fig = plt.figure(figsize=(20, 5))
-        indices = np.random.choice(self.samples['pred'].shape[0],size=100,replace=False)
+        npred = self.pred.shape[0]
+        indices = np.random.choice(npred,size=min(100, npred),replace=False)
+        means = self.samples['mean'][::self.pred_thin]
 
         plt.errorbar(self.time,self.flux,yerr=self.flux_err,linestyle='none',marker='.',color='k')
 
+        med = np.median(self.flux)
         for index in indices:
-            plt.plot(self.t_fine,self.samples['pred'][index,:] + self.samples['mean'][index] + jnp.median(self.flux),alpha=0.1,color='C0')
+            plt.plot(self.t_fine,self.pred[index,:] + means[index] + med,alpha=0.1,color='C0')
         plt.xlabel("Time [days]")
         plt.ylabel("Relative flux")
         plt.xlim(self.t_fine.min(),self.t_fine.max())
@@ -565,6 +743,160 @@ class RotationModel(object):
             return fig
 
 
+@contextmanager
+def _x64(enabled):
+    """
+    Set JAX's 64 bit mode for the duration of a block, then restore it.
+    """
+    previous = jax.config.jax_enable_x64
+    jax.config.update("jax_enable_x64", enabled)
+    try:
+        yield
+    finally:
+        jax.config.update("jax_enable_x64", previous)
+
+
+def _percentile_range(x, lo, hi):
+    """
+    The difference between the hi and lo percentiles of x.
+
+    Equivalent to np.percentile(x, hi) - np.percentile(x, lo), with the
+    linear interpolation np.percentile uses, but with a single partial sort.
+    """
+    n = len(x)
+    if n < 20:
+        return np.percentile(x, hi) - np.percentile(x, lo)
+    pos = np.array([lo, hi])/100.*(n - 1)
+    k = np.floor(pos).astype(int)
+    part = np.partition(x, np.unique(np.concatenate([k, k + 1])))
+    q = part[k] + (pos - k)*(part[k + 1] - part[k])
+    return q[1] - q[0]
+
+
+def _downsample(t, f, n):
+    """
+    Evenly thin a light curve to at most n points, for plotting.
+    """
+    if len(t) <= n:
+        return t, f
+    idx = np.linspace(0, len(t) - 1, n).astype(int)
+    return t[idx], f[idx]
+
+
+def _rotation_model(t, yerr, log_min_yerr, log_std_y, log_init_period,
+                    y=None):
+    """
+    The numpyro model used by RotationModel.gp_rotation.
+
+    Everything that depends on the light curve is an argument, so that a
+    compiled sampler can be reused for any light curve of the same length.
+    """
+    # The mean flux of the time series
+    mean = numpyro.sample("mean", dist.Normal(0.0, 10.0))
+
+    # A jitter term describing excess white noise
+    log_jitter = numpyro.sample("log_jitter", dist.Normal(log_min_yerr, 2.5))
+
+    log_Sw4 = numpyro.sample("log_Sw4", dist.Normal(log_std_y, 2.5))
+    log_w0 = numpyro.sample("log_w0", dist.Normal(jnp.log(2 * jnp.pi / 10.), 5.0))
+
+    # The parameters of the RotationTerm kernel
+    log_sigma = numpyro.sample("log_sigma", dist.Normal(log_std_y, 2.5))
+    log_period = numpyro.sample("log_period", dist.Normal(log_init_period, 2.0))
+    log_Q0 = numpyro.sample("log_Q0", dist.Normal(2.0, 4.0))
+    log_deltaQ = numpyro.sample("log_deltaQ", dist.Normal(2.0, 10.0))
+    log_f = numpyro.sample("log_f", dist.Uniform(-4, 0))
+
+    # Track the period as a deterministic
+    period = numpyro.deterministic("period",jnp.exp(log_period))
+    params = {'log_sigma': log_sigma, 'log_period': log_period, 'log_Q0': log_Q0,
+                'log_deltaQ': log_deltaQ, 'log_f': log_f, 
+                'mean': mean, 'log_jitter': log_jitter,
+                'log_Sw4': log_Sw4, 'log_w0': log_w0}
+
+    gp = build_gp(params,t,yerr)
+    numpyro.sample("gp", gp.numpyro_dist(), obs=y)
+
+
+@lru_cache(maxsize=8)
+def _get_mcmc(tune, draws, num_chains, chain_method, n_points, precision):
+    """
+    Build the sampler used by RotationModel.gp_rotation.
+
+    Samplers are cached, so that repeated calls (e.g. when looping over many
+    stars) reuse the sampler's jitted functions rather than rebuilding them.
+    A sampler's compiled state is tied to the shapes of the data it was
+    first run on, so the cache is keyed on the number of data points,
+    n_points, and their precision, as well as the sampler settings.
+    The model arguments are traced (jit_model_args) and there is no progress
+    bar, so warmup and sampling each run as a single compiled loop.
+    """
+    nuts_kernel = NUTS(_rotation_model, dense_mass=True,
+                       target_accept_prob=0.9)
+    return MCMC(
+        nuts_kernel,
+        num_warmup=tune,
+        num_samples=draws,
+        num_chains=num_chains,
+        chain_method=chain_method,
+        jit_model_args=True,
+        progress_bar=False,
+    )
+
+
+class UnderdampedSHOSum(kernels.quasisep.Quasisep):
+    """
+    A sum of underdamped (Q > 1/2) SHO kernels.
+
+    Equivalent to adding together kernels.quasisep.SHO terms, but the
+    state-space matrices of every term are built in a single vectorized
+    operation, and without SHO's branching on the damping regime.
+
+    Args:
+        sigma (array): The amplitude of each term.
+        omega (array): The angular frequency of each term.
+        quality (array): The quality factor of each term. Must be > 1/2.
+    """
+
+    sigma: jax.Array
+    omega: jax.Array
+    quality: jax.Array
+
+    def design_matrix(self):
+        w, q = self.omega, self.quality
+        zero, one = jnp.zeros_like(w), jnp.ones_like(w)
+        blocks = jnp.stack([jnp.stack([zero, one], axis=-1),
+                            jnp.stack([-w**2, -w/q], axis=-1)], axis=-2)
+        return Block(*blocks)
+
+    def stationary_covariance(self):
+        w = self.omega
+        zero, one = jnp.zeros_like(w), jnp.ones_like(w)
+        blocks = jnp.stack([jnp.stack([one, zero], axis=-1),
+                            jnp.stack([zero, w**2], axis=-1)], axis=-2)
+        return Block(*blocks)
+
+    def observation_model(self, X):
+        del X
+        return jnp.stack([self.sigma, jnp.zeros_like(self.sigma)],
+                         axis=-1).ravel()
+
+    def transition_matrix(self, X1, X2):
+        dt = X2 - X1
+        w, q = self.omega, self.quality
+        # Floor f so that Q = 1/2 to numerical precision still takes the
+        # (critically damped) limit rather than dividing by zero.
+        f = jnp.sqrt(jnp.maximum(4 * q**2 - 1, jnp.finfo(w.dtype).tiny))
+        arg = 0.5 * f * w * dt / q
+        sin, cos = jnp.sin(arg), jnp.cos(arg)
+        blocks = jnp.exp(-0.5 * w * dt / q)[:, None, None] * jnp.stack(
+            [jnp.stack([cos + sin / f, -2 * q * w * sin / f], axis=-1),
+             jnp.stack([2 * q * sin / (w * f), cos - sin / f], axis=-1)],
+            axis=-2)
+        return Block(*blocks)
+
+
+@jax.jit
 def build_gp(params,t,yerr):
 
     sigma, period, Q0, dQ, f = (jnp.exp(params['log_sigma']), jnp.exp(params['log_period']), 
@@ -582,19 +914,13 @@ def build_gp(params,t,yerr):
     w2 = 8 * jnp.pi * Q2 / (period * jnp.sqrt(4 * Q2**2 - 1))
     S2 = f * amp / (w2 * Q2)
 
-    # SHOTerm(S0=S1, w0=w1, Q=Q1), SHOTerm(S0=S2, w0=w2, Q=Q2)
-    kernel = kernels.quasisep.SHO(
-        sigma=S1,
-        omega=w1,
-        quality=Q1,
-    ) + kernels.quasisep.SHO(
-        sigma=S2,
-        omega=w2,
-        quality=Q2
-    ) + kernels.quasisep.SHO(
-        sigma=Sw4/w0**4,
-        omega=w0,
-        quality=1/np.sqrt(2)
+    # SHOTerm(S0=S1, w0=w1, Q=Q1), SHOTerm(S0=S2, w0=w2, Q=Q2), plus a
+    # Q = 1/sqrt(2) term for the granulation background. All three are
+    # underdamped, so they are evaluated together as one kernel.
+    kernel = UnderdampedSHOSum(
+        sigma=jnp.stack([S1, S2, Sw4/w0**4]),
+        omega=jnp.stack([w1, w2, w0]),
+        quality=jnp.stack([Q1, Q2, jnp.full_like(Q1, 1/np.sqrt(2))]),
     )
     
     return GaussianProcess(
@@ -1,28 +1,29 @@
+from functools import lru_cache
+from math import tau
+
 import numpy as np
+from numpy.random import default_rng
+import pytest
 from starspot import phase_dispersion_minimization as pdm
 import matplotlib.pyplot as plt
 import starspot as ss
 
 
 def test_sj2():
-    np.random.seed(42)
+    rng = default_rng(42)
     N = 10000
-    t = np.linspace(0, .1, N)
-    x = np.random.randn(N)
+    x = rng.standard_normal(N)
     sj2 = pdm.sj2(x, 0, N)
-    assert np.isclose(sj2, 1, atol=.01)
+    assert np.isclose(sj2, 1, atol=.05)
 
 
 def test_s2():
-    np.random.seed(42)
+    rng = default_rng(42)
     N = 10000
     M = 10
     nj = np.ones(M) * N
-    sj2 = np.zeros(M)
-    for j in range(M):
-        t = np.linspace(0, .1, N)
-        x = np.random.randn(N)
-        sj2[j] = pdm.sj2(x, 0, nj[j])
+    X = rng.standard_normal((M, N))
+    sj2 = X.var(axis=1, ddof=1)
     s2 = pdm.s2(nj, sj2, M)
     assert np.isclose(s2, 1, atol=.01)
 
@@ -30,10 +31,10 @@ def test_s2():
 def test_phase():
 
     # Generate some data
+    rng = default_rng(42)
     t = np.linspace(0, 100, 1000)
     p = 10
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
 
     phase = pdm.calc_phase(10, t)
 
@@ -48,33 +49,38 @@ def test_phase_bins():
     """
 
     # Generate some data
+    rng = default_rng(42)
     t = np.linspace(0, 100, 1000)
     p = 10
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
 
     nbins = 10
 
+    # Fold on all three trial periods at once
+    phases = pdm.calc_phase_grid([2.5, 5, 10], t)
+    assert np.array_equal(phases[1], pdm.calc_phase(5, t))
+
     # Try a period of 2.5
-    phase = pdm.calc_phase(2.5, t)
+    phase = phases[0]
     x_means, phase_bins, Ns, sj2s, x_binned, phase_binned = \
         pdm.phase_bins(nbins, phase, x)
-    mid_phase_bins = np.diff(phase_bins) * .5 + phase_bins[:-1]
+    # The bin edges are the same for every period.
+    mid_phase_bins = .5*(phase_bins[1:] + phase_bins[:-1])
     s225 = pdm.s2(Ns, sj2s, nbins)
+    assert x_binned is None and phase_binned is None
 
     # Try a period of 5
-    phase = pdm.calc_phase(5, t)
+    phase = phases[1]
     x_means, phase_bins, Ns, sj2s, x_binned, phase_binned = \
         pdm.phase_bins(nbins, phase, x)
-    mid_phase_bins = np.diff(phase_bins) * .5 + phase_bins[:-1]
     s25 = pdm.s2(Ns, sj2s, nbins)
 
     # Try a period of 10
-    phase = pdm.calc_phase(10, t)
+    phase = phases[2]
     x_means, phase_bins, Ns, sj2s, x_binned, phase_binned = \
-        pdm.phase_bins(nbins, phase, x)
-    mid_phase_bins = np.diff(phase_bins) * .5 + phase_bins[:-1]
+        pdm.phase_bins(nbins, phase, x, return_bins=True)
     s210 = pdm.s2(Ns, sj2s, nbins)
+    assert [len(xb) for xb in x_binned] == list(Ns)
 
     # Plot each bin
     for j in range(nbins):
@@ -108,10 +114,10 @@ def test_phase_bins():
 def test_phi():
 
     # Generate some data
+    rng = default_rng(42)
     t = np.linspace(0, 100, 1000)
     p = 10
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
 
     # Generate some data
     # t = np.linspace(0, 100, 1000)
@@ -126,7 +132,7 @@ def test_phi():
     # plt.plot(t, x1)
     # plt.plot(t, x2)
     # plt.plot(t, x3)
-    x += np.random.randn(len(x))*.1
+    x += rng.standard_normal(len(x))*.1
     # plt.plot(t, x)
     # plt.savefig("test")
 
@@ -134,19 +140,17 @@ def test_phi():
     nperiods = 200
     nbins = 10
     periods = np.linspace(1, 20, nperiods)
-    phis = np.zeros(nperiods)
-    for i, p in enumerate(periods):
-        phis[i] = pdm.phi(nbins, p, t, x)
+    total_variance = np.var(x, ddof=1)
+    phis, (x_means, Ns, sj2s) = pdm.phi_grid(
+        nbins, periods, t, x, total_variance=total_variance, return_best=True)
 
     # Find period with the lowest Phi
     ind = np.argmin(phis)
     pplot = periods[ind]
     # pplot = 10
 
-    # Get variances for that period
-    phase = pdm.calc_phase(pplot, t)
-    x_means, phase_bs, Ns, sj2s, xb, pb = pdm.phase_bins(nbins, phase, x)
-    mid_phase_bins = np.diff(phase_bs)*.5 + phase_bs[:-1]
+    # Variances for that period, and the bin centres
+    mid_phase_bins = (np.arange(nbins) + .5)/nbins
 
     # Calculate the phase at that period (for plotting)
     phase = pdm.calc_phase(pplot, t)
@@ -175,89 +179,134 @@ def test_phi():
     assert np.isclose(periods[ind], 10, atol=.1)
 
 
-def test_uncertainty():
+@pytest.fixture(scope="module")
+def t():
+    return np.linspace(0, 100, 1000)
+
+
+@pytest.fixture(scope="module")
+def signal(t):
+    """The noiseless light curve with period p, shared between tests."""
+    @lru_cache(maxsize=8)
+    def _signal(p):
+        x = np.sin(tau/p*t)
+        x.flags.writeable = False
+        return x
+    return _signal
+
+
+# The true period and the period grid searched for each light curve.
+nperiods = 200
+uncertainty_cases = [
+    (10, np.linspace(1, 20, nperiods)),
+    (2, np.linspace(.1, 5, nperiods)),
+    (5, np.linspace(.1, 10, nperiods)),
+    (20, np.linspace(5, 30, nperiods)),
+    # Long periods are searched on a grid that is uniform in frequency, so
+    # every peak is sampled equally well, with 5 samples per 1/baseline.
+    (50, 1/np.linspace(1, 1/200, 500)),
+    (100, 1/np.linspace(1, 1/200, 500)),
+]
+
+
+@pytest.mark.parametrize("p, period_grid", uncertainty_cases)
+def test_uncertainty(t, signal, p, period_grid):
 
     # Generate some data
-    np.random.seed(42)
-    t = np.linspace(0, 100, 1000)
-    p = 10
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+    rng = default_rng(42)
+    x = signal(p) + rng.standard_normal(len(t))*1e-2
     xerr = np.ones_like(x)*1e-2
 
     rm = ss.RotationModel(t, x, xerr)
-    nperiods = 200
-    period_grid = np.linspace(1, 20, nperiods)
     pdm_period, period_err = rm.pdm_rotation(period_grid)
     print(pdm_period, period_err)
     # fig = rm.pdm_plot()
-    # plt.savefig("pdm_test")
+    # plt.savefig("pdm_test_{}".format(p))
 
-    # 2 day period
-    np.random.seed(42)
-    p = 2
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
-    xerr = np.ones_like(x)*1e-2
-    period_grid = np.linspace(.1, 5, nperiods)
-    rm = ss.RotationModel(t, x, xerr)
-    pdm_period, period_err = rm.pdm_rotation(period_grid)
-    print(pdm_period, period_err)
-    # fig = rm.pdm_plot()
-    # plt.savefig("pdm_test_2")
+    # The period should be found to within a fifth of the width of the
+    # dispersion trough, p**2/baseline.
+    baseline = t.max() - t.min()
+    assert np.isclose(pdm_period, p, atol=p**2/baseline/5)
 
-    # 5 day period
-    np.random.seed(42)
-    p = 5
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
-    xerr = np.ones_like(x)*1e-2
-    period_grid = np.linspace(.1, 10, nperiods)
-    rm = ss.RotationModel(t, x, xerr)
-    pdm_period, period_err = rm.pdm_rotation(period_grid)
-    print(pdm_period, period_err)
-    # fig = rm.pdm_plot()
-    # plt.savefig("pdm_test_5")
 
-    # 20 day period
-    p = 20
-    np.random.seed(42)
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+def test_refine_long_period(t, signal):
+    # A coarse grid around a trough that spans most of the baseline: the
+    # refined period must stay within half a grid step of the grid minimum.
+    rng = default_rng(42)
+    p = 100
+    x = signal(p) + rng.standard_normal(len(t))*1e-2
     xerr = np.ones_like(x)*1e-2
-    period_grid = np.linspace(5, 30, nperiods)
+    period_grid = 1/np.linspace(1, 1/200, 200)
+
     rm = ss.RotationModel(t, x, xerr)
-    pdm_period, period_err = rm.pdm_rotation(period_grid)
-    print(pdm_period, period_err)
-    # fig = rm.pdm_plot()
-    # plt.savefig("pdm_test_20")
+    grid_period, _ = rm.pdm_rotation(period_grid)
+    assert np.isclose(grid_period, p)
+    refined_period, _ = rm.pdm_rotation(period_grid, refine=True)
+    df = (1 - 1/200)/(len(period_grid) - 1)
+    assert abs(1/refined_period - 1/grid_period) <= .5*df + 1e-12
+
+    # On an uneven grid, a vertex further than half the smaller step from
+    # the minimum is rejected.
+    freqs = np.array([.1, .2, .21])
+    assert pdm._parabola_vertex(1/freqs, [.5001, .5, .6]) == 1/freqs[1]
+
+    # A finely sampled trough is refined.
+    p = 10.3
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
+    period_grid = np.linspace(1, 20, 200)
+    rm = ss.RotationModel(t, x, xerr)
+    grid_period, _ = rm.pdm_rotation(period_grid)
+    refined_period, _ = rm.pdm_rotation(period_grid, refine=True)
+    assert abs(refined_period - p) < abs(grid_period - p)
+
 
-    # 50 day period
-    np.random.seed(42)
+def test_pdm_backends():
+
+    # Generate some data
+    rng = default_rng(42)
     t = np.linspace(0, 100, 1000)
-    p = 50
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+    p = 10
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
     xerr = np.ones_like(x)*1e-2
-    period_grid = 10**np.linspace(0, np.log10(200), nperiods)
-    rm = ss.RotationModel(t, x, xerr)
-    pdm_period, period_err = rm.pdm_rotation(period_grid)
-    print(pdm_period, period_err)
-    # fig = rm.pdm_plot()
-    # plt.savefig("pdm_test_50")
 
-    # 100 day period
-    np.random.seed(42)
-    p = 100
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
-    xerr = np.ones_like(x)*1e-2
-    period_grid = 10**np.linspace(0, np.log10(200), nperiods)
-    rm = ss.RotationModel(t, x, xerr)
-    pdm_period, period_err = rm.pdm_rotation(period_grid)
-    print(pdm_period, period_err)
-    # fig = rm.pdm_plot()
-    # plt.savefig("pdm_test_100")
+    period_grid = np.linspace(1, 20, 200)
+    # The backends must agree for times in BJD, too, where single precision
+    # alone would only resolve about 0.25 d.
+    for t0 in [0, 2457000]:
+        rm = ss.RotationModel(t + t0, x, xerr)
+        rm.pdm_rotation(period_grid, backend="cpu")
+        cpu_phis = rm.phis
+        rm.pdm_rotation(period_grid, backend="jax")
+        assert np.allclose(rm.phis, cpu_phis, atol=1e-3)
+
+
+def test_pdm_c():
+    pdm_c = pytest.importorskip("starspot._pdm_c")
+
+    # Generate some data
+    rng = default_rng(42)
+    t = np.linspace(0, 100, 1000)
+    p = 10
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
+
+    period_grid = np.linspace(1, 20, 200)
+    total_variance = np.var(x, ddof=1)
+    assert np.allclose(pdm_c.pdm_grid(10, period_grid, t, x, total_variance),
+                       pdm._pdm_grid(10, period_grid, t, x, total_variance))
+
+
+def test_pdm_cupy():
+    pytest.importorskip("cupy")
+
+    # Generate some data
+    rng = default_rng(42)
+    t = np.linspace(0, 100, 1000)
+    p = 10
+    x = np.sin(tau/p*t) + rng.standard_normal(len(t))*1e-2
+
+    period_grid = np.linspace(1, 20, 200)
+    assert np.allclose(pdm.phi_grid(10, period_grid, t, x, backend="cupy"),
+                       pdm.phi_grid(10, period_grid, t, x, backend="cpu"))
 
 
 if __name__ == "__main__":
@@ -267,10 +316,11 @@ if __name__ == "__main__":
     # Generate some data
     t = np.linspace(0, 100, 1000)
     p = 10
-    w = 2*np.pi/p
-    x = np.sin(w*t) + np.random.randn(len(t))*1e-2
+    x = np.sin(tau/p*t) + default_rng(42).standard_normal(len(t))*1e-2
 
     test_phase()
     test_phase_bins()
     test_phi()
-    test_uncertainty()
+    for p, period_grid in uncertainty_cases:
+        test_uncertainty(t, p, period_grid)
+    test_pdm_backends()
@@ -1,4 +1,5 @@
 import numpy as np
+import jax
 from starspot import phase_dispersion_minimization as pdm
 import matplotlib.pyplot as plt
 import starspot as ss
@@ -27,6 +28,73 @@ def test_big_plot():
     # fig3.savefig("big_plot_test3")
 
 
+def test_ls():
+    time = np.linspace(0, 100, 1000)
+    p = 10
+    w = 2*np.pi/p
+    flux = np.sin(w*time) + np.random.randn(len(time))*1e-2
+    flux_err = np.ones_like(flux)*1e-2
+    rotate = ss.RotationModel(time, flux, flux_err)
+    ls_period = rotate.ls_rotation()
+    assert np.isclose(ls_period, 10, atol=.1)
+
+
+def test_ls_input_period():
+    time = np.linspace(0, 100, 1000)
+    flux = np.sin(2*np.pi/10*time) + np.random.randn(len(time))*1e-2
+    flux_err = np.ones_like(flux)*1e-2
+    rotate = ss.RotationModel(time, flux, flux_err)
+    rotate.ls_rotation()
+    assert rotate.ls_rotation(max_period=20, input_ls_period=3.3) == 3.3
+    assert len(rotate.freq) == len(rotate.power)
+    assert np.isclose(rotate.ls_rotation(max_period=20), 10, atol=.1)
+    assert len(rotate.freq) == len(rotate.power)
+
+
+def test_reset_series():
+    time = np.linspace(0, 100, 1000)
+    flux = np.sin(2*np.pi/10*time) + np.random.randn(len(time))*1e-2
+    flux_err = np.ones_like(flux)*1e-2
+    rotate = ss.RotationModel(time, flux, flux_err)
+    assert np.isclose(rotate.ls_rotation(), 10, atol=.1)
+
+    flux = np.sin(2*np.pi/5*time) + np.random.randn(len(time))*1e-2
+    rotate.reset_series(flux, flux_err)
+    assert np.isclose(rotate.ls_rotation(), 5, atol=.1)
+    assert np.isclose(rotate.pdm_rotation(np.linspace(1, 20, 200))[0], 5,
+                      atol=.1)
+
+
+def test_gp_rotation_lengths():
+    # The cached sampler must not be reused for light curves of a
+    # different length.
+    rng = np.random.default_rng(42)
+    for n in [100, 150]:
+        time = np.linspace(0, 30, n)
+        flux = 1 + .01*np.sin(2*np.pi/7*time) + rng.normal(0, .001, n)
+        flux_err = np.ones_like(flux)*1e-3
+        rotate = ss.RotationModel(time, flux, flux_err)
+        rotate.gp_rotation(tune=10, draws=10, num_chains=2,
+                           prediction=False)
+        assert rotate.samples["period"].shape == (20,)
+
+
+def test_gp_rotation_precision():
+    # The cached sampler must not be reused across precisions.
+    rng = np.random.default_rng(42)
+    time = np.linspace(0, 30, 100)
+    flux = 1 + .01*np.sin(2*np.pi/7*time) + rng.normal(0, .001, len(time))
+    flux_err = np.ones_like(flux)*1e-3
+    rotate = ss.RotationModel(time, flux, flux_err)
+    x64 = jax.config.jax_enable_x64
+    for precision in ["float64", "float32"]:
+        rotate.gp_rotation(tune=10, draws=10, num_chains=2,
+                           prediction=False, precision=precision)
+        assert rotate.samples["period"].dtype == precision
+        # The user's x64 setting is left as it was.
+        assert jax.config.jax_enable_x64 == x64
+
+
 def test_acf():
     time = np.linspace(0, 100, 1000)
     p = 10